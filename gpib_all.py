@@ -1,23 +1,48 @@
 """Module providing an interface to the GPIB-USB adapter"""
+import io
+import os
 import time
+import select
 import socket
+import selectors
+from functools import lru_cache
 import serial
 
+@lru_cache(maxsize=128)
+def _encode_cmd(message):
+    """Return the bytes sent to the adapter for message"""
+    return f"{message}\n".encode("ASCII")
+
 class SerialError(Exception):
     """Serial error exception"""
 
 class RemoteSerialError(Exception):
     """Serial error exception"""
 
+class GPIBTimeoutError(Exception):
+    """No data received from the gpib adapter in time"""
+
 class AR488Base():
     """Base class to represent AR488 adapter.
     The AR488 is an Arduino-based USB-GPIB adapter.
     For details see: https://github.com/Twilight-Logic/AR488
     """
 
-    def __init__(self, debug):
+    __slots__ = ("address", "timeout", "debug", "_rx")
+
+    # Seconds of silence after which a buffer transfer is considered complete
+    _IDLE_TIMEOUT = 0.5
+    # Delay after set_address() and local(), which change the adapter/bus state.
+    # Not from the AR488 documentation: a quarter of the 200 ms that used to
+    # follow every write, kept as a margin for these two commands only.
+    _SETTLE_TIME = 0.05
+
+    def __init__(self, timeout, debug):
         self.address = 0
+        self.timeout = timeout
         self.debug = debug
+        # Bytes received after the last line returned by _receive_bytes
+        self._rx = bytearray()
 
     def __enter__(self):
         return self
@@ -25,11 +50,28 @@ class AR488Base():
     def send(self, message):
         """Send something to the gpib adapter"""
 
+    def _recv(self):
+        """Return the bytes available on the connection to the adapter"""
+        return b""
+
+    def _receive_bytes(self):
+        """Receive raw bytes from the gpib adapter"""
+        # Read everything pending at once and keep what follows the reply line
+        while b"\n" not in self._rx:
+            if not self._wait_input(self.timeout):
+                break
+            data = self._recv()
+            if not data:
+                break
+            self._rx.extend(data)
+        line, sep, self._rx = self._rx.partition(b"\n")
+        return line + sep
+
     def receive(self):
         """Receive something from the gpib adapter"""
-        return False
+        return self._receive_bytes().decode("UTF-8").strip()
 
-    def write(self, message, sleep=0.2):
+    def write(self, message, sleep=0):
         """Write message to GPIB bus."""
         if self.debug:
             print("->", message)
@@ -39,17 +81,34 @@ class AR488Base():
 
     def read(self):
         """Read from GPIB bus."""
-        return self.get_string(show_byte=False)
+        return self.get_string(show_byte=False, idle_timeout=self.timeout)
 
-    def query(self, message, sleep=0.2):
-        """Write message to GPIB bus and read results."""
+    def query(self, message, sleep=0, timeout=15):
+        """Write message to GPIB bus and read results.
+        The whole reply is returned, read until the adapter timeout passes
+        without new data.
+        """
+        return self._transact(message, sleep, timeout)
+
+    def batch(self, commands, replies, timeout=15):
+        """Write several messages to GPIB bus at once and read results.
+        Only use it when the adapter can execute the commands back to back
+        and the number of reply lines to wait for is known.
+        Lines after the expected replies are kept for receive() and are
+        returned first by the next read or query.
+        """
+        self.write("\n".join(commands))
+        lines = []
+        while len(lines) < replies and self._readable(timeout):
+            lines.append(self.receive())
+        return lines
 
     def set_address(self, address):
         """Specify address of GPIB device with which to communicate.
         When the AR488 is in device mode rather than controller mode, this
         instead sets the address of the AR488.
         """
-        self.write(f"++addr {address}")
+        self.write(f"++addr {address}", self._SETTLE_TIME)
         self.address = address
 
     def get_current_address(self):
@@ -63,40 +122,82 @@ class AR488Base():
 
     def local(self):
         """Return to local mode"""
-        self.write("++loc")
+        self.write("++loc", self._SETTLE_TIME)
 
-    def wait_for_data(self):
+    def wait_for_data(self, timeout=15):
         """Wait for the data to arrive"""
+        if self._rx:
+            data, self._rx = self._rx, bytearray()
+            return data
+        if not self._wait_input(timeout):
+            raise GPIBTimeoutError(f"No data received in {timeout} s")
+        data = self._recv()
+        if not data:
+            raise GPIBTimeoutError("Connection closed by the adapter")
+        return data
+
+    @staticmethod
+    def _wait_readable(fd, timeout):
+        """Block until fd is readable or timeout expires"""
+        readable, _, _ = select.select([fd], [], [], timeout)
+        return bool(readable)
+
+    def _wait_input(self, timeout): # pylint: disable=unused-argument
+        """Wait until the connection to the adapter is readable"""
         return False
 
-    def get_buffer(self,
-                   show_byte=True # pylint: disable=unused-argument
-                  ):
+    def _readable(self, timeout):
+        """Wait until there is data to receive from the adapter"""
+        return bool(self._rx) or self._wait_input(timeout)
+
+    def _transact(self, message, sleep=0, timeout=15):
+        """Send message and return the whole reply, read until the adapter is quiet"""
+        self.write(message, sleep)
+        try:
+            data = self.wait_for_data(timeout)
+        except GPIBTimeoutError as e:
+            raise GPIBTimeoutError(f"No reply to {message!r} in {timeout} s") from e
+        return self._drain(data, False, self.timeout).decode("UTF-8").strip()
+
+    def _drain(self, data, show_byte, idle_timeout):
+        """Receive data after data until nothing arrives for idle_timeout"""
+        chunks = [data]
+        l = len(data)
+        if show_byte:
+            print(f"\r{l}", end="")
+        while self._wait_input(idle_timeout):
+            data = self._recv()
+            if not data:
+                break
+            chunks.append(data)
+            l += len(data)
+            if show_byte:
+                print(f"\r{l}", end="")
+        if show_byte:
+            print()
+        return b"".join(chunks)
+
+    def get_buffer(self, show_byte=True, idle_timeout=None):
         """Receive all the data from the instrument"""
-        return False
+        if idle_timeout is None:
+            idle_timeout = self._IDLE_TIMEOUT
+        return self._drain(self.wait_for_data(), show_byte, idle_timeout)
 
-    def get_string(self,
-                   show_byte=True # pylint: disable=unused-argument
-                  ):
+    def get_string(self, show_byte=True, idle_timeout=None):
         """Receive all the data as string from the instrument"""
-        tmp = self.get_buffer(show_byte)
-        if not isinstance(tmp, bool):
-            return tmp.decode("UTF-8").strip()
-        return False
+        return self.get_buffer(show_byte, idle_timeout).decode("UTF-8").strip()
 
     def get_plot_buffer(self, show_byte=True):
         """Get plot data from the instrument (Device-initialed plot)"""
-        _buffer = self.get_buffer(show_byte)
-        if not isinstance(_buffer, bool):
-            return _buffer.decode("UTF-8")
-        return False
+        return self.get_buffer(show_byte)
 
     def get_plot_file(self, filename, show_byte=True):
         """Get plot data from the instrument (Device-initialed plot) (file .plt)"""
-        _buffer = self.get_plot_buffer(show_byte)
-        if isinstance(_buffer, bool):
+        try:
+            _buffer = self.get_plot_buffer(show_byte)
+        except GPIBTimeoutError:
             return False
-        with open(filename, "w", encoding="utf-8") as binary_file:
+        with open(filename, "wb") as binary_file:
             binary_file.write(_buffer)
         return True
 
@@ -106,8 +207,9 @@ class AR488Base():
 
     def get_pcl_print_file(self, filename, show_byte=True):
         """Get PLC print data from the instrument (Device-initialed print) (file .pcl)"""
-        _buffer = self.get_pcl_print_buffer(show_byte)
-        if not isinstance(_buffer, bool):
+        try:
+            _buffer = self.get_pcl_print_buffer(show_byte)
+        except GPIBTimeoutError:
             return False
         with open(filename, "wb") as binary_file:
             binary_file.write(_buffer)
@@ -119,10 +221,23 @@ class AR488(AR488Base):
     For details see: https://github.com/Twilight-Logic/AR488
     """
 
+    __slots__ = ("ser", "_fd")
+
     def __init__(self, port="/dev/ttyACM3", baudrate=115200, timeout=.2, debug=False):
-        super().__init__(debug)
+        super().__init__(timeout, debug)
         try:
             self.ser = serial.Serial(port=port, baudrate=baudrate, timeout=timeout)
+            try:
+                # Raw descriptor used for I/O, self.ser keeps the port configured and open
+                self._fd = self.ser.fileno()
+            except io.UnsupportedOperation:
+                # No file descriptor (Windows): do the I/O through pyserial
+                self._fd = None
+            try:
+                # Avoid the 16 ms latency timer of the USB-serial chip (Linux only)
+                self.ser.set_low_latency_mode(True)
+            except (NotImplementedError, OSError, AttributeError, ValueError):
+                pass
             self.address = self.query("++addr")
         except (serial.serialutil.SerialException, FileNotFoundError) as e:
             raise SerialError(f"Error opening serial port {port}") from e
@@ -140,53 +255,37 @@ class AR488(AR488Base):
             pass
 
     def __str__(self):
-        return "GPIB address: " + str(self.address) + ", Port: " +\
-            self.ser.name + ", Baud rate: " + str(self.ser.baudrate)
-
-    def send(self, message):
-        """Send something to the gpib adapter"""
-        self.ser.write(f"{message}\n".encode("ASCII"))
-
-    def receive(self):
-        """Receive something from the gpib adapter"""
-        return self.ser.readline().decode("UTF-8").strip()
-
-    def query(self, message, sleep=0.2):
-        """Write message to GPIB bus and read results."""
-        self.write(message, sleep)
-        return self.read()
-
-    def wait_for_data(self):
-        """Wait for the data to arrive"""
-        num_retry = 15
+        return (f"GPIB address: {self.address}, Port: {self.ser.name}, "
+                f"Baud rate: {self.ser.baudrate}")
+
+    def _wait_input(self, timeout):
+        """Wait until the connection to the adapter is readable"""
+        if self._fd is not None:
+            return self._wait_readable(self._fd, timeout)
+        deadline = time.monotonic() + timeout
         while not self.ser.in_waiting:
-            time.sleep(1)
-            num_retry -= 1
-            if num_retry == 0:
+            if time.monotonic() >= deadline:
                 return False
+            time.sleep(0.001)
         return True
 
-    def get_buffer(self, show_byte=True):
-        """Receive all the data from the instrument"""
-        _buffer = bytearray()
-        l = 0
-        data = self.wait_for_data()
-        if isinstance(data, bool) and not data:
-            return False
-        while True:
+    def send(self, message):
+        """Send something to the gpib adapter"""
+        if self._fd is None:
+            self.ser.write(_encode_cmd(message))
+            return
+        data = memoryview(_encode_cmd(message))
+        while data:
             try:
-                data = self.ser.read(256)
-            except TimeoutError:
-                break
-            l += len(data)
-            if show_byte:
-                print(f"\r{l}", end="")
-            if not data:
-                break
-            _buffer.extend(data)
-        if show_byte:
-            print()
-        return _buffer
+                data = data[os.write(self._fd, data):]
+            except BlockingIOError:
+                select.select([], [self._fd], [], self.timeout)
+
+    def _recv(self):
+        """Return the bytes available on the connection to the adapter"""
+        if self._fd is None:
+            return self.ser.read(self.ser.in_waiting or 1)
+        return os.read(self._fd, 65536)
 
 class AR488Wifi(AR488Base):
     """Class to represent AR488 WiFi-GPIB adapter.
@@ -195,74 +294,59 @@ class AR488Wifi(AR488Base):
     and: https://github.com/jeelabs/esp-link
     """
 
+    __slots__ = ("ip", "session", "_sel")
+
     def __init__(self, ip, timeout=.2, debug=False):
-        super().__init__(debug)
+        super().__init__(timeout, debug)
         self.ip = ip
-        self.timeout = timeout
         try:
-            socket.setdefaulttimeout(self.timeout)
             self.session = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.session.settimeout(self.timeout)
+            # The receive buffer must be sized before connect() to affect the TCP window
+            self.session.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 65536)
             self.session.connect((self.ip, 23))
+            # Send short commands immediately instead of waiting for Nagle coalescing
+            self.session.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.session.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            # Wait for replies on a selector (epoll on Linux) instead of blocking in recv()
+            self.session.setblocking(False)
+            self._sel = selectors.DefaultSelector()
+            self._sel.register(self.session, selectors.EVENT_READ)
             self.address = self.query("++addr")
         except OSError as e:
             if e.errno == 113:
                 raise RemoteSerialError(f"Error opening serial port at {self.ip}") from e
 
     def __del__(self):
+        try:
+            self._sel.close()
+        except AttributeError:
+            pass
         self.session.close()
 
     def __exit__(self, exc_type, exc_value, exc_tb):
+        try:
+            self._sel.close()
+        except AttributeError:
+            pass
         self.session.close()
 
     def __str__(self):
-        return "GPIB address: " + str(self.address) + ", IP: " + self.ip
+        return f"GPIB address: {self.address}, IP: {self.ip}"
+
+    def _wait_input(self, timeout):
+        """Wait until the connection to the adapter is readable"""
+        return bool(self._sel.select(timeout))
 
     def send(self, message):
         """Send something to the gpib adapter"""
-        self.session.sendall(f"{message}\n".encode("ASCII"))
-
-    def receive(self):
-        """Receive something from the gpib adapter"""
-        return self.session.recv(1024).decode("UTF-8").strip()
-
-    def wait_for_data(self):
-        """Wait until data arrive"""
-        num_retry = 15
-        while True:
-            try:
-                data = self.session.recv(1024)
-                if data:
-                    return data
-            except TimeoutError:
-                time.sleep(1)
-                num_retry -= 1
-                if num_retry == 0:
-                    return False
-
-    def get_buffer(self, show_byte=True):
-        """Receive all the data from the instrument"""
-        _buffer = bytearray()
-        l = 0
-        data = self.wait_for_data()
-        if isinstance(data, bool):
-            return False
-        _buffer.extend(data)
-        while True:
+        data = memoryview(_encode_cmd(message))
+        while data:
             try:
-                data = self.session.recv(1024)
-            except TimeoutError:
-                break
-            l += len(data)
-            if show_byte:
-                print(f"\r{l}", end="")
-            if not data:
-                break
-            _buffer.extend(data)
-        if show_byte:
-            print()
-        return _buffer
+                data = data[self.session.send(data):]
+            except BlockingIOError:
+                select.select([], [self.session], [], self.timeout)
 
-    def query(self, message, sleep=0.2):
-        """Write message to GPIB bus and read results."""
-        self.write(message, sleep)
-        return self.read()
+    def _recv(self):
+        """Return the bytes available on the connection to the adapter"""
+        return self.session.recv(65536)